@@ -1,7 +1,13 @@
-from flask import Flask, render_template, request, session, redirect, url_for
+from flask import Flask, render_template, request, session, redirect, url_for, jsonify
 import json
 import os
+import math
+import threading
+import time
+import uuid
 from datetime import datetime
+from functools import wraps
+from collections import OrderedDict
 import sqlite3
 from contextlib import contextmanager
 
@@ -9,6 +15,16 @@ app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
 app.config['DATABASE'] = 'students.db'
 
+# Admission control for write endpoints
+app.config['RATE_LIMIT_BURST'] = 20          # tokens per client bucket
+app.config['RATE_LIMIT_PER_SECOND'] = 2.0    # token refill rate
+app.config['RATE_LIMIT_MAX_CLIENTS'] = 10000 # buckets kept before evicting the least recent
+app.config['DB_WRITER_LIMIT'] = 1            # concurrent DB writers (SQLite allows one)
+app.config['DB_WRITER_WAIT'] = 2.0           # seconds a writer may queue before 503
+
+# Raw quiz attempts older than this are moved to quiz_attempts_archive
+app.config['ATTEMPT_RETENTION_DAYS'] = 90
+
 # Database setup
 def init_db():
     try:
@@ -18,6 +34,8 @@ def init_db():
             
             # Drop tables if they exist (for clean reset)
             cursor.execute('DROP TABLE IF EXISTS quiz_attempts')
+            cursor.execute('DROP TABLE IF EXISTS quiz_attempts_archive')
+            cursor.execute('DROP TABLE IF EXISTS student_stats')
             cursor.execute('DROP TABLE IF EXISTS students')
             cursor.execute('DROP TABLE IF EXISTS challenger_votes')
             cursor.execute('DROP TABLE IF EXISTS poetry_votes')
@@ -34,6 +52,7 @@ def init_db():
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
+            cursor.execute('CREATE INDEX idx_students_name ON students (first_name, last_name)')
             
             # Create quiz_attempts table
             cursor.execute('''
@@ -46,6 +65,29 @@ def init_db():
                     FOREIGN KEY (student_id) REFERENCES students (id)
                 )
             ''')
+            cursor.execute('CREATE INDEX idx_quiz_attempts_timestamp ON quiz_attempts (timestamp)')
+            
+            # Create quiz_attempts_archive table (same shape, filled by archive_old_attempts)
+            cursor.execute('''
+                CREATE TABLE quiz_attempts_archive (
+                    id INTEGER PRIMARY KEY,
+                    student_id INTEGER,
+                    score INTEGER,
+                    total_questions INTEGER,
+                    timestamp DATETIME
+                )
+            ''')
+            
+            # Create student_stats table (running aggregates over all attempts, archived included)
+            cursor.execute('''
+                CREATE TABLE student_stats (
+                    student_id INTEGER PRIMARY KEY,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    best_score INTEGER NOT NULL DEFAULT 0,
+                    score_sum INTEGER NOT NULL DEFAULT 0,
+                    FOREIGN KEY (student_id) REFERENCES students (id)
+                )
+            ''')
             
             # Create challenger_votes table
             cursor.execute('''
@@ -76,14 +118,124 @@ def init_db():
         print(f"Error initializing database: {e}")
 
 @contextmanager
-def get_db():
-    conn = sqlite3.connect(app.config['DATABASE'])
+def get_db(timeout=5.0):
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=timeout)
     conn.row_factory = sqlite3.Row
     try:
         yield conn
     finally:
         conn.close()
 
+# Admission control
+# SQLite allows a single writer, so a burst of submissions turns into
+# "database is locked" errors. Clients are throttled with a token bucket and
+# writers are capped by a semaphore; excess load gets 429/503 with Retry-After.
+
+class DatabaseBusy(Exception):
+    """Raised when a writer could not get a DB slot within DB_WRITER_WAIT"""
+
+_rate_buckets = OrderedDict()  # least recently used first
+_rate_lock = threading.Lock()
+_writer_slots = None
+_writer_slots_lock = threading.Lock()
+
+ADMISSION_METRICS = {
+    'rate_limited': {},
+    'writer_timeouts': 0,
+    'writes': 0,
+}
+_metrics_lock = threading.Lock()
+
+@app.before_request
+def issue_client_id():
+    """Give each browser a random id on its first page view, before it posts anything"""
+    if request.method == 'GET' and 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+
+def client_key():
+    """Identify the client by its session id, or by remote IP if it sent none"""
+    # A request without an existing id (e.g. a cookieless script) must not get
+    # a fresh bucket every time, so it shares the bucket of its IP instead
+    if 'client_id' in session:
+        return f"session:{session['client_id']}"
+    return f"ip:{request.remote_addr}"
+
+def take_token(key):
+    """Take a token from the client's bucket, return seconds to wait if empty"""
+    burst = app.config['RATE_LIMIT_BURST']
+    rate = app.config['RATE_LIMIT_PER_SECOND']
+    now = time.monotonic()
+    
+    with _rate_lock:
+        tokens, last = _rate_buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / rate
+        if not wait:
+            tokens -= 1
+        
+        # Re-inserting moves the key to the end, so eviction drops the oldest
+        _rate_buckets[key] = (tokens, now)
+        while len(_rate_buckets) > app.config['RATE_LIMIT_MAX_CLIENTS']:
+            _rate_buckets.popitem(last=False)
+        
+        return wait
+
+def rate_limited(view):
+    """Throttle POST requests to a view with a per-client token bucket"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'POST':
+            wait = take_token(f"{request.endpoint}:{client_key()}")
+            if wait:
+                with _metrics_lock:
+                    rejected = ADMISSION_METRICS['rate_limited']
+                    rejected[request.endpoint] = rejected.get(request.endpoint, 0) + 1
+                return ('طلبات كثيرة، الرجاء المحاولة بعد قليل', 429,
+                        {'Retry-After': str(math.ceil(wait))})
+        return view(*args, **kwargs)
+    return wrapper
+
+def writer_slots():
+    """Get the writer semaphore, resized if DB_WRITER_LIMIT has changed"""
+    global _writer_slots
+    limit = app.config['DB_WRITER_LIMIT']
+    
+    with _writer_slots_lock:
+        if _writer_slots is None or _writer_slots[0] != limit:
+            _writer_slots = (limit, threading.BoundedSemaphore(limit))
+        return _writer_slots[1]
+
+def writer_timed_out():
+    with _metrics_lock:
+        ADMISSION_METRICS['writer_timeouts'] += 1
+    return DatabaseBusy()
+
+@contextmanager
+def write_db():
+    """Like get_db, but waits for one of the limited writer slots first"""
+    deadline = time.monotonic() + app.config['DB_WRITER_WAIT']
+    slots = writer_slots()
+    if not slots.acquire(timeout=app.config['DB_WRITER_WAIT']):
+        raise writer_timed_out()
+    try:
+        # SQLite's own lock wait only gets what is left of DB_WRITER_WAIT
+        with get_db(timeout=max(deadline - time.monotonic(), 0)) as conn:
+            try:
+                yield conn
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                raise writer_timed_out()
+        with _metrics_lock:
+            ADMISSION_METRICS['writes'] += 1
+    finally:
+        slots.release()
+
+@app.errorhandler(DatabaseBusy)
+def database_busy(error):
+    return ('الخادم مشغول حالياً، الرجاء المحاولة بعد قليل', 503,
+            {'Retry-After': str(math.ceil(app.config['DB_WRITER_WAIT']))})
+
 # Quiz questions about Algerian War of Independence
 QUESTIONS = [
     {
@@ -306,7 +458,7 @@ def save_student_result(first_name, last_name, score, total_questions):
     """Save student result to database and return student info"""
     percentage = (score / total_questions) * 100
     
-    with get_db() as conn:
+    with write_db() as conn:
         cursor = conn.cursor()
         
         # Check if student already exists
@@ -340,6 +492,16 @@ def save_student_result(first_name, last_name, score, total_questions):
             (student_id, score, total_questions)
         )
         
+        # Update running aggregates so stats never need to scan quiz_attempts
+        cursor.execute('''
+            INSERT INTO student_stats (student_id, attempts, best_score, score_sum)
+            VALUES (?, 1, ?, ?)
+            ON CONFLICT (student_id) DO UPDATE SET
+                attempts = attempts + 1,
+                best_score = MAX(best_score, excluded.best_score),
+                score_sum = score_sum + excluded.score_sum
+        ''', (student_id, score, score))
+        
         conn.commit()
     
     return student_id
@@ -370,16 +532,57 @@ def get_student_stats(first_name, last_name):
         cursor = conn.cursor()
         cursor.execute('''
             SELECT s.first_name, s.last_name, s.score, s.total_questions, s.percentage, s.timestamp,
-                   COUNT(qa.id) as attempts,
-                   MAX(qa.score) as best_score,
-                   AVG(qa.score) as average_score
+                   COALESCE(st.attempts, 0) as attempts,
+                   st.best_score as best_score,
+                   st.score_sum * 1.0 / NULLIF(st.attempts, 0) as average_score
             FROM students s
-            LEFT JOIN quiz_attempts qa ON s.id = qa.student_id
+            LEFT JOIN student_stats st ON s.id = st.student_id
             WHERE s.first_name = ? AND s.last_name = ?
-            GROUP BY s.id
         ''', (first_name, last_name))
         return cursor.fetchone()
 
+def archive_old_attempts(retention_days=None, batch_size=500):
+    """Move quiz attempts older than the retention period to the archive table"""
+    if retention_days is None:
+        retention_days = app.config['ATTEMPT_RETENTION_DAYS']
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT datetime('now', ?)", (f'-{int(retention_days)} days',))
+        cutoff = cursor.fetchone()[0]
+    
+    # Move rows in small batches, each in its own transaction, so quiz and
+    # vote submissions can take the writer slot in between
+    archived = 0
+    while True:
+        with write_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id FROM quiz_attempts WHERE timestamp < ? ORDER BY id LIMIT ?',
+                (cutoff, batch_size)
+            )
+            batch = cursor.fetchall()
+            if not batch:
+                break
+            last_id = batch[-1]['id']
+            
+            # Aggregates already live in student_stats, so only the raw rows move
+            cursor.execute('''
+                INSERT INTO quiz_attempts_archive (id, student_id, score, total_questions, timestamp)
+                SELECT id, student_id, score, total_questions, timestamp
+                FROM quiz_attempts
+                WHERE timestamp < ? AND id <= ?
+            ''', (cutoff, last_id))
+            cursor.execute('DELETE FROM quiz_attempts WHERE timestamp < ? AND id <= ?', (cutoff, last_id))
+            
+            conn.commit()
+        
+        archived += len(batch)
+        if len(batch) < batch_size:
+            break
+    
+    return archived
+
 def get_rank_info(score, total_questions):
     """Determine rank based on score"""
     percentage = (score / total_questions) * 100
@@ -409,7 +612,7 @@ def has_user_voted_poetry(first_name, last_name):
 
 def save_poetry_vote(first_name, last_name, contestant_id):
     """Save user's poetry competition vote"""
-    with get_db() as conn:
+    with write_db() as conn:
         cursor = conn.cursor()
         cursor.execute(
             'INSERT INTO poetry_votes (voter_first_name, voter_last_name, contestant_id) VALUES (?, ?, ?)',
@@ -445,6 +648,7 @@ def index():
     return render_template('index.html', top_students=top_students)
 
 @app.route('/quiz', methods=['GET', 'POST'])
+@rate_limited
 def quiz():
     if request.method == 'POST':
         # Store user info in session
@@ -466,6 +670,7 @@ def quiz():
     return render_template('quiz.html')
 
 @app.route('/question', methods=['GET', 'POST'])
+@rate_limited
 def question():
     if 'first_name' not in session:
         return redirect(url_for('quiz'))
@@ -475,22 +680,27 @@ def question():
         user_answer = request.form.get('answer')
         current_q_index = session['current_question']
         correct_answer = QUESTIONS[current_q_index]['correct']
+        is_correct = user_answer == correct_answer
+        
+        if current_q_index + 1 >= len(QUESTIONS):
+            # Save student result when quiz is completed, before touching the
+            # session so a 503 from a busy database lets the answer be resubmitted
+            save_student_result(session['first_name'], session['last_name'],
+                                session['score'] + int(is_correct), len(QUESTIONS))
         
         session['answers'].append({
             'question': QUESTIONS[current_q_index]['question'],
             'user_answer': user_answer,
             'correct_answer': correct_answer,
-            'is_correct': user_answer == correct_answer
+            'is_correct': is_correct
         })
         
-        if user_answer == correct_answer:
+        if is_correct:
             session['score'] += 1
         
         session['current_question'] += 1
         
         if session['current_question'] >= len(QUESTIONS):
-            # Save student result when quiz is completed
-            save_student_result(session['first_name'], session['last_name'], session['score'], len(QUESTIONS))
             return redirect(url_for('results'))
     
     if session['current_question'] >= len(QUESTIONS):
@@ -573,6 +783,7 @@ def six_members():
     return render_template('six_members.html')
 
 @app.route('/poetry-competition', methods=['GET', 'POST'])
+@rate_limited
 def poetry_competition():
     """Route for poetry competition voting"""
     if request.method == 'POST':
@@ -623,6 +834,7 @@ def poetry_competition():
                          ask_name=True)
 
 @app.route('/save-user-info', methods=['POST'])
+@rate_limited
 def save_user_info():
     """Save user info to session from poetry page"""
     first_name = request.form.get('first_name', '').strip().title()
@@ -655,11 +867,37 @@ def poetry_results():
                          contestants=contestants_with_votes,
                          total_votes=total_votes)
 
+@app.route('/admission-metrics')
+def admission_metrics():
+    """Rejection counters for the rate-limited write endpoints"""
+    with _metrics_lock:
+        return jsonify({
+            'rate_limited': dict(ADMISSION_METRICS['rate_limited']),
+            'writer_timeouts': ADMISSION_METRICS['writer_timeouts'],
+            'writes': ADMISSION_METRICS['writes'],
+            'tracked_clients': len(_rate_buckets),
+        })
+
 @app.route('/restart')
 def restart():
+    # Keep the rate-limit id so restarting does not hand out a fresh bucket
+    client_id = session.get('client_id')
     session.clear()
+    if client_id:
+        session['client_id'] = client_id
     return redirect(url_for('quiz'))
 
+@app.route('/compact-attempts')
+def compact_attempts():
+    """Route to archive old quiz attempts (for maintenance)"""
+    try:
+        archived = archive_old_attempts()
+        return f"Archived {archived} quiz attempts! <a href='/'>Go Home</a>"
+    except DatabaseBusy:
+        raise
+    except Exception as e:
+        return f"Error archiving quiz attempts: {str(e)}"
+
 @app.route('/reset-db')
 def reset_db():
     """Route to reset and recreate the database (for development only)"""